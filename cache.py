@@ -0,0 +1,124 @@
+"""Local cache for the LLM responses.
+
+Email threads about collections are often structurally very similar,
+for example the same thread arrives again with just a new reply appended.
+Responses are cached by a normalized version of the discussion, so that
+differences in whitespace, signatures or quote headers don't cause
+a new LLM call. Threads that discuss the same invoices are also stored
+with a structural key, which allows updating a previous response with
+only the changed lines instead of processing the whole thread again.
+
+The cache is stored in LLM_CACHE_DIR, relative to the working directory
+by default. Control Room discards the working directory after each run,
+so point it to persistent storage for the cache to be reused between runs.
+Entries expire after LLM_CACHE_EXPIRE seconds (a week by default)."""
+
+import difflib
+import functools
+import hashlib
+import os
+import re
+from typing import Optional, Tuple
+
+from diskcache import Cache
+
+
+CACHE_DIR = os.getenv("LLM_CACHE_DIR", ".llm_cache")
+CACHE_EXPIRE = int(os.getenv("LLM_CACHE_EXPIRE", 7 * 24 * 60 * 60))
+
+# A "-- " signature separator line and the signature after it, up to the
+# quoted or forwarded history of the thread: a quote header, a ">" quoted
+# line, a forwarded or original message marker, or a "From:" header line.
+SIGNATURE_RE = re.compile(
+    r"^--[ \t]*$.*?(?="
+    r"^On .* wrote:[ \t]*$"
+    r"|^>"
+    r"|^-+ *Forwarded message *-+"
+    r"|^-+ *Original Message *-+"
+    r"|^Begin forwarded message:"
+    r"|^From:"
+    r"|\Z)",
+    re.MULTILINE | re.DOTALL | re.IGNORECASE,
+)
+# Quote headers such as "On Fri, Jun 30, 2023 at 11:18, Someone wrote:".
+QUOTE_HEADER_RE = re.compile(r"^On .* wrote:[ \t]*$", re.MULTILINE)
+WHITESPACE_RE = re.compile(r"\s+")
+# Long numbers in the discussion are most likely invoice or account ids.
+IDENTIFIER_RE = re.compile(r"\b\d{5,}\b")
+
+
+@functools.lru_cache(maxsize=1)
+def _get_cache() -> Cache:
+    """Open the cache on first use, so that importing this module doesn't
+    create the cache directory."""
+    return Cache(CACHE_DIR)
+
+
+def strip_discussion(discussion: str) -> str:
+    """Remove the parts of the discussion that don't affect the response."""
+    discussion = SIGNATURE_RE.sub("", discussion)
+    discussion = QUOTE_HEADER_RE.sub("", discussion)
+    return "\n".join(line.strip() for line in discussion.splitlines() if line.strip())
+
+
+def normalize(discussion: str) -> str:
+    """Return the normalized representation of the discussion."""
+    return WHITESPACE_RE.sub(" ", strip_discussion(discussion)).strip().lower()
+
+
+def _exact_key(discussion: str, version: str) -> str:
+    digest = hashlib.sha256(normalize(discussion).encode()).hexdigest()
+    return f"exact:{version}:{digest}"
+
+
+def _structural_key(discussion: str, version: str) -> Optional[str]:
+    identifiers = sorted(set(IDENTIFIER_RE.findall(normalize(discussion))))
+    if not identifiers:
+        return None
+    digest = hashlib.sha256(" ".join(identifiers).encode()).hexdigest()
+    return f"structure:{version}:{digest}"
+
+
+def lookup(discussion: str, version: str) -> Optional[str]:
+    """Return the cached LLM response content for the discussion, if any.
+
+    The version identifies the model and prompts the response was created
+    with, so that changing them doesn't return stale responses."""
+    return _get_cache().get(_exact_key(discussion, version))
+
+
+def lookup_similar(discussion: str, version: str) -> Optional[Tuple[str, str]]:
+    """Find a cached response of a discussion about the same invoices.
+
+    Returns a tuple of the changed lines between the cached and the given
+    discussion, and the cached response content."""
+    key = _structural_key(discussion, version)
+    if key is None:
+        return None
+
+    cached = _get_cache().get(key)
+    if cached is None:
+        return None
+
+    diff = "\n".join(
+        line
+        for line in difflib.ndiff(
+            cached["discussion"].splitlines(),
+            strip_discussion(discussion).splitlines(),
+        )
+        if line.startswith(("+ ", "- "))
+    )
+    return diff, cached["content"]
+
+
+def store(discussion: str, version: str, content: str):
+    """Store the LLM response content for the discussion."""
+    _get_cache().set(_exact_key(discussion, version), content, expire=CACHE_EXPIRE)
+
+    key = _structural_key(discussion, version)
+    if key is not None:
+        _get_cache().set(
+            key,
+            {"discussion": strip_discussion(discussion), "content": content},
+            expire=CACHE_EXPIRE,
+        )
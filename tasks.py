@@ -8,23 +8,44 @@ The use case simulated here is to act as a helper to a B2B payment
 collections, but by editing the prompts and the code, you can use this
 for any other use case, too."""
 
+import asyncio
+import functools
+import hashlib
+import os
+import re
+import traceback
+from typing import List, Optional, Tuple
+
 from robocorp.tasks import task
 from robocorp import vault, workitems
 import openai
-import json
-import traceback
-from email import message_from_file
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Header
-
+from openai import AsyncOpenAI
+import cache
+import csscompressor
+import ijson
+from jinja2 import Environment
+from markupsafe import Markup
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from urllib3.util.retry import Retry
+
+
+# All the static instructions are in the system prompt, which forms the
+# beginning of every request, so that the provider's prompt cache can reuse
+# it between the calls. Only the email discussion varies.
+SYSTEM_PROMPT = """You are an assistant that deals with payment collections. Your role is to extract structured data from the email conversations and suggest the next best replies.
 
-PROMPT_TEMPLATE = """Acting as a helper to a payment collections agent for a B2B company, your task is to get the relevant data out of the email discussion with the customer. The email thread is about unpaid invoices.
+Acting as a helper to a payment collections agent for a B2B company, your task is to get the relevant data out of the email discussion with the customer. The email thread is about unpaid invoices.
 
 Your specific task is to return data per each separate invoice in the thread, indicating what customer has responded to each of the invoices payment status. Produce a JSON-formatted response only.
 
-This is the email conversation between the agent and the customer:
-###--DISCUSSION--###
-
 The response must be in the JSON format containing the following keys and values:
 {
 "summary": "summary of the entire conversation in max 3 sentences",
@@ -42,111 +63,100 @@ Description of the statuses in the above JSON format:
 - other: anything other than above
 
 Make sure that the `invoices` list will contain the correct promised payment date, if it is mentioned that the invoice will be or was paid at a specific date, or empty string otherwise.
-
-Please give only the properly structured JSON in the response (not code, not comments, not anything else):
 """
 
-SYSTEM_PROMPT = """You are an assistant that deals with payment collections. Your role is to extract structured data from the email conversations and suggest the next best replies.
+DISCUSSION_PROMPT = """This is the email conversation between the agent and the customer:
 """
 
-def initialize():
-    """Initialize the desired LLM and Email API clients.
-    This example uses OpenAI API and SendGrid, which are configured
-    in the Robocorp Vault."""
-
-    openai_secrets_container = vault.get_secret("OpenAI")
-    model = "gpt-4"
-    openai.api_key = openai_secrets_container["key"]
-
-    # Set up SendGrid API client
-    sg_secrets_container = vault.get_secret("Sendgrid")
-    from_email = sg_secrets_container["FROM_EMAIL"]
-    sg_client = SendGridAPIClient(sg_secrets_container["SENDGRID_API_KEY"])
-
-    return sg_client, from_email, model
-
-
-def create_prompt(discussion: str) -> str:
-    """Construct the prompt for the LLM using template."""
-
-    # It's also possible to use Robocorp Asset Storage for templates,
-    # which allows editing them without releasing a new version
-    # of the robot.
-    # PROMPT_TEMPLATE = storage.get_asset("llm-prompt-template")
-
-    # Replace the discussion placeholder with the actual discussion
-    prompt = PROMPT_TEMPLATE.replace("--DISCUSSION--", discussion)
-    return prompt
-
-
-def create_system_prompt() -> str:
-    """Return the system prompt for the LLM"""
-
-    # It's also possible to use Robocorp Asset Storage for templates,
-    # which allows editing them without releasing a new version
-    # of the robot.
-    # SYSTEM_PROMPT = storage.get_asset("llm-system-prompt")
-    return SYSTEM_PROMPT
+# Short discussions without any invoice references or monetary values,
+# such as bounces or acknowledgements, are not sent to the LLM.
+TRIVIAL_LENGTH = 200
+INVOICE_RE = re.compile(
+    r"\bINV[-_/ ]?\d{4,}\b|invoice\s*#?\s*\d{3,}|\b\d{6,}\b", re.IGNORECASE
+)
+# Amounts with a currency, thousand separators or decimals. Numbers that
+# continue with another separator, such as dates like 23.05.2023, are not
+# amounts.
+MONEY_RE = re.compile(
+    r"[$€£]\s*\d|\b(?:USD|EUR|GBP)\s*\d|\d\s*(?:USD|EUR|GBP)\b"
+    r"|(?<!\d)(?<!\d[.,])\d{1,3}(?:,\d{3})+(?:\.\d{2})?(?![.,]?\d)"
+    r"|(?<!\d)(?<!\d[.,])\d+\.\d{2}(?![.,]?\d)",
+    re.IGNORECASE,
+)
+
+# Generic acknowledgement used as the response for trivial discussions.
+TRIVIAL_RESPONSE = orjson.dumps(
+    {
+        "summary": "The discussion does not refer to any invoices, so it was not analyzed further.",
+        "account_id": "",
+        "invoices": [],
+        "suggested_reply": "Thank you for your message.",
+    }
+).decode()
+
+# JSON schema for the structured output of the LLM, matching the keys
+# described in the system prompt above.
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "account_id": {"type": "string"},
+        "invoices": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "invoice_id": {"type": "string"},
+                    "total_value": {"type": "string"},
+                    "currency": {"type": "string"},
+                    "status": {
+                        "type": "string",
+                        "enum": [
+                            "paid",
+                            "payment_promised",
+                            "dispute",
+                            "request_info",
+                            "waiting_approval",
+                            "other",
+                        ],
+                    },
+                    "promised_payment_date": {"type": "string"},
+                    "summary": {"type": "string"},
+                },
+                "required": [
+                    "invoice_id",
+                    "total_value",
+                    "currency",
+                    "status",
+                    "promised_payment_date",
+                    "summary",
+                ],
+                "additionalProperties": False,
+            },
+        },
+        "suggested_reply": {"type": "string"},
+    },
+    "required": ["summary", "account_id", "invoices", "suggested_reply"],
+    "additionalProperties": False,
+}
 
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "collections", "strict": True, "schema": RESPONSE_SCHEMA},
+}
 
-def construct_email_reply(response: str) -> str:
-    """Construct the email reply based on the response from the LLM."""
-    try:
-        json_data = json.loads(response["choices"][0]["message"]["content"])
-    except json.JSONDecodeError as e:
-        print("Error decoding JSON:", str(e))
-        return ""
-    except Exception as e:
-        print("An error occurred:", str(e))
-        return ""
+DEFAULT_MODEL = "gpt-4o-mini"
 
-    reply = f"""
-{get_css_template()}
-<body>
-<h2>SUMMARY</h2>
-{json_data.get("summary", "No summary was returned")}
+# Cheap model used to update a cached response of a similar discussion.
+PATCH_MODEL = "gpt-4o-mini"
 
-<h2>SUGGESTED REPLY</h2>
-{json_data.get("suggested_reply", "No suggested reply was returned")}
+PATCH_PROMPT = """Below is the JSON previously extracted from an email discussion with the customer, followed by the lines that have changed in the discussion since then (lines starting with "+" were added, lines starting with "-" were removed). Update the JSON to reflect the changes, following the same rules as before.
 
-<h2>INVOICES</h2>
-<table>
-<thead>
-    <tr>
-        <th class="resizable">Invoice ID</th>
-        <th class="resizable">Value</th>
-        <th class="resizable">Status</th>
-        <th class="resizable">Payment promised</th>
-        <th class="resizable">Summary</th>
-        <th class="resizable">Action</th>
-    </tr>
-</thead>
-<tbody>
+Previously extracted JSON:
 """
-    for invoice in json_data.get("invoices", []):
-        reply += f"""
-        <tr>
-            <td>{invoice.get("invoice_id", "NO ID")}</td>
-            <td>{invoice.get("total_value", "NO VALUE")} {invoice.get("currency", "")}</td>
-            <td>{invoice.get("status", "NO STATUS")}</td>
-            <td>{invoice.get("promised_payment_date", "NO PROMISED DATE")}</td>
-            <td>{invoice.get("summary", "NO SUMMARY")}</td>
-            <td><a href="https://www.w3.org/Provider/Style/dummy.html">Update AR</a></td>
-        </tr>
-"""
-
-    reply += "</tbody></table><br /><p>Bot Generated Reply Ends Here</p>"
 
-    return reply
-
-
-def get_css_template():
-    """Return the CSS template for the email reply."""
-    return """
-<!DOCTYPE html>
-<html>
-<head>
-  <style>
+# The static parts of the HTML reply, built once at import time.
+CSS_STYLES = """
     /* CSS styles */
     @import url('https://fonts.googleapis.com/css2?family=Roboto:wght@400;700&display=swap');
 
@@ -198,67 +208,521 @@ def get_css_template():
     th.resizable:hover:after {
       background-color: #cccccc;
     }
-  </style>
+"""
+
+# The styles are embedded in every reply, so they are minified. Mail clients
+# differ in their support for external stylesheets, so they are not linked.
+CSS_TEMPLATE = f"""<!DOCTYPE html>
+<html>
+<head>
+<style>{csscompressor.compress(CSS_STYLES)}</style>
 </head>
 """
 
+HTML_HEAD = CSS_TEMPLATE + "<body>\n"
 
-@task
-def process_emails():
-    """Read email, do LLM magic and reply to the sender."""
+# Templates are compiled once, and autoescaping keeps the content coming
+# from the customer emails from breaking or injecting into the HTML.
+TEMPLATE_ENV = Environment(autoescape=True, auto_reload=False)
 
-    # Inititalize it all
-    sg, from_email, model = initialize()
-    sys_prompt = create_system_prompt()
+REPLY_BODY_TEMPLATE = TEMPLATE_ENV.from_string(
+    """<h2>SUMMARY</h2>
+{{ summary | default("No summary was returned") }}
+
+<h2>SUGGESTED REPLY</h2>
+{{ suggested_reply | default("No suggested reply was returned") }}
+
+<h2>INVOICES</h2>
+<table>
+<thead>
+    <tr>
+        <th class="resizable">Invoice ID</th>
+        <th class="resizable">Value</th>
+        <th class="resizable">Status</th>
+        <th class="resizable">Payment promised</th>
+        <th class="resizable">Summary</th>
+        <th class="resizable">Action</th>
+    </tr>
+</thead>
+<tbody>
+{% for row in invoice_rows %}{{ row }}{% endfor %}
+</tbody></table><br /><p>Bot Generated Reply Ends Here</p>"""
+)
+
+INVOICE_ROW_TEMPLATE = TEMPLATE_ENV.from_string(
+    """
+        <tr>
+            <td>{{ invoice_id | default("NO ID") }}</td>
+            <td>{{ total_value | default("NO VALUE") }} {{ currency }}</td>
+            <td>{{ status | default("NO STATUS") }}</td>
+            <td>{{ promised_payment_date | default("NO PROMISED DATE") }}</td>
+            <td>{{ summary | default("NO SUMMARY") }}</td>
+            <td><a href="https://www.w3.org/Provider/Style/dummy.html">Update AR</a></td>
+        </tr>
+"""
+)
+
+SENDGRID_API_URL = "https://api.sendgrid.com/v3"
+
+# Maximum number of concurrent LLM requests, to stay within the rate limits.
+DEFAULT_MAX_CONCURRENCY = 8
+
+# Attempts for the LLM and SendGrid calls failing with transient errors.
+# SendGrid requests are only retried when they were not accepted.
+MAX_ATTEMPTS = 5
+
+
+@functools.lru_cache(maxsize=1)
+def create_sendgrid_session(api_key: str) -> requests.Session:
+    """Create a HTTP session for SendGrid API that keeps the connections
+    open between the requests. SendGrid's own client opens a new
+    connection for every request."""
+
+    session = requests.Session()
+    session.headers.update(
+        {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+    )
+    # Only rate limited requests and errors while connecting are retried,
+    # as those were not accepted and can't result in duplicate emails.
+    retry = Retry(
+        total=MAX_ATTEMPTS - 1,
+        connect=MAX_ATTEMPTS - 1,
+        read=0,
+        other=0,
+        backoff_factor=0.5,
+        status_forcelist=(429,),
+        allowed_methods=frozenset({"GET", "POST"}),
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+
+def initialize():
+    """Initialize the desired LLM and Email API clients.
+    This example uses OpenAI API and SendGrid, which are configured
+    in the Robocorp Vault. The clients are reused by all the items.
+
+    The OpenAI client is bound to the running event loop, so it must be
+    created inside the loop and closed when done with it."""
+
+    openai_secrets_container = vault.get_secret("OpenAI")
+    # The model can be changed from the Vault, or overridden with
+    # the OPENAI_MODEL environment variable (for example "gpt-4o"). The model
+    # must support structured outputs, so for example "gpt-4" does not work.
+    model = os.getenv(
+        "OPENAI_MODEL", openai_secrets_container.get("model", DEFAULT_MODEL)
+    )
+    # A single async client is shared by all items, so the underlying
+    # HTTP connections are pooled and reused between requests. Retries
+    # are done in call_llm(), so the client's own retries are disabled.
+    openai_client = AsyncOpenAI(
+        api_key=openai_secrets_container["key"], max_retries=0
+    )
+
+    # Set up SendGrid API client
+    sg_secrets_container = vault.get_secret("Sendgrid")
+    from_email = sg_secrets_container["FROM_EMAIL"]
+    sg_client = create_sendgrid_session(sg_secrets_container["SENDGRID_API_KEY"])
+
+    return openai_client, sg_client, from_email, model
+
+
+async def warm_up(openai_client, sg):
+    """Open the connections to OpenAI and SendGrid with cheap requests,
+    so that the first actual requests don't pay for the TLS handshakes.
+    The results, and any errors, are ignored.
+
+    This is run concurrently with reading the work items, as running it
+    before any work would only add its round trips to the latency."""
+
+    await asyncio.gather(
+        openai_client.models.list(),
+        asyncio.to_thread(sg.get, f"{SENDGRID_API_URL}/user/profile"),
+        return_exceptions=True,
+    )
+
+
+def create_prompt(discussion: str) -> list:
+    """Construct the user messages for the LLM using template."""
+
+    # It's also possible to use Robocorp Asset Storage for templates,
+    # which allows editing them without releasing a new version
+    # of the robot.
+    # DISCUSSION_PROMPT = storage.get_asset("llm-prompt-template")
+
+    # The instructions are in the system prompt, so the user message
+    # contains only the discussion.
+    return [{"role": "user", "content": DISCUSSION_PROMPT + discussion}]
+
+
+def create_system_prompt() -> str:
+    """Return the system prompt for the LLM"""
+
+    # It's also possible to use Robocorp Asset Storage for templates,
+    # which allows editing them without releasing a new version
+    # of the robot.
+    # SYSTEM_PROMPT = storage.get_asset("llm-system-prompt")
+    return SYSTEM_PROMPT
+
+
+def is_transient_error(exception: BaseException) -> bool:
+    """Return True for LLM errors worth retrying: rate limits, server
+    errors and connection problems."""
+    return isinstance(
+        exception,
+        (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError),
+    )
+
+
+def retrying() -> AsyncRetrying:
+    """Return a retrier for the LLM calls that can fail with transient errors.
+    SendGrid requests are retried by the HTTP session instead."""
+    return AsyncRetrying(
+        stop=stop_after_attempt(MAX_ATTEMPTS),
+        wait=wait_exponential_jitter(),
+        retry=retry_if_exception(is_transient_error),
+        reraise=True,
+    )
+
+
+async def call_llm(
+    openai_client, model: str, messages: list
+) -> Tuple[str, List[Markup]]:
+    """Call the LLM and return the content of the response, along with the
+    HTML rows of the invoices in it. Transient errors are retried."""
+    return await retrying()(stream_llm, openai_client, model, messages)
+
+
+async def stream_llm(
+    openai_client, model: str, messages: list
+) -> Tuple[str, List[Markup]]:
+    """Call the LLM and return the content of the response, along with the
+    HTML rows of the invoices in it.
+
+    The response is streamed and parsed incrementally, so that the invoice
+    rows are rendered while the rest of the response is still generated."""
+
+    stream = await openai_client.chat.completions.create(
+        model=model,
+        temperature=0,
+        messages=messages,
+        response_format=RESPONSE_FORMAT,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+
+    content = []
+    refusal = []
+    invoice_rows = []
+    invoices = ijson.sendable_list()
+    parser = ijson.items_coro(invoices, "invoices.item")
+
+    async for chunk in stream:
+        if chunk.usage:
+            # Print some debug info
+            print(f"*********** TOKEN USAGE *************\n{chunk.usage}\n\n")
+            if chunk.usage.prompt_tokens_details:
+                print(
+                    f"*********** CACHED PROMPT TOKENS *************\n{chunk.usage.prompt_tokens_details.cached_tokens}\n\n"
+                )
+        if not chunk.choices:
+            continue
+
+        delta = chunk.choices[0].delta
+        if delta.refusal:
+            refusal.append(delta.refusal)
+        if delta.content:
+            content.append(delta.content)
+            parser.send(delta.content.encode())
+            invoice_rows.extend(render_invoice_row(invoice) for invoice in invoices)
+            del invoices[:]
+
+    if refusal:
+        print("LLM refused to answer:", "".join(refusal))
+        return "", []
+
+    parser.close()
+    return "".join(content), invoice_rows
+
+
+def cache_version(model: str, sys_prompt: str) -> str:
+    """Return the version of the LLM responses for the response cache,
+    which changes whenever the model, prompts or the schema change."""
+    return hashlib.sha256(
+        orjson.dumps(
+            [model, sys_prompt, DISCUSSION_PROMPT, PATCH_PROMPT, RESPONSE_SCHEMA]
+        )
+    ).hexdigest()[:16]
+
+
+def is_trivial_discussion(discussion: str) -> bool:
+    """Return True if the discussion has nothing for the LLM to extract,
+    such as bounces or one-line acknowledgements."""
+    return (
+        len(discussion.strip()) < TRIVIAL_LENGTH
+        and not INVOICE_RE.search(discussion)
+        and not MONEY_RE.search(discussion)
+    )
+
+
+async def get_llm_response(
+    openai_client, model: str, sys_prompt: str, discussion: str
+) -> Tuple[str, Optional[List[Markup]]]:
+    """Return the LLM response content for the discussion, using the local
+    response cache when possible. The invoice rows are returned when they
+    were already rendered while streaming the response."""
+
+    if is_trivial_discussion(discussion):
+        print("*********** TRIVIAL DISCUSSION, LLM CALL SKIPPED *************\n\n")
+        return TRIVIAL_RESPONSE, None
+
+    version = cache_version(model, sys_prompt)
+    content = cache.lookup(discussion, version)
+    if content is not None:
+        print("*********** RESPONSE CACHE HIT *************\n\n")
+        return content, None
+
+    similar = cache.lookup_similar(discussion, version)
+    if similar is not None:
+        # Same invoices discussed before, only update the changed parts.
+        print("*********** RESPONSE CACHE SIMILAR HIT *************\n\n")
+        diff, cached_content = similar
+        content, invoice_rows = await call_llm(
+            openai_client,
+            PATCH_MODEL,
+            [
+                {"role": "system", "content": sys_prompt},
+                {"role": "user", "content": PATCH_PROMPT + cached_content},
+                {"role": "user", "content": diff},
+            ],
+        )
+    else:
+        content, invoice_rows = await call_llm(
+            openai_client,
+            model,
+            [{"role": "system", "content": sys_prompt}, *create_prompt(discussion)],
+        )
+
+    if content:
+        cache.store(discussion, version, content)
+    return content, invoice_rows
+
+
+def render_invoice_row(invoice: dict) -> Markup:
+    """Render the HTML table row of a single invoice."""
+    # Markup makes the already escaped row safe to include in the body.
+    return Markup(INVOICE_ROW_TEMPLATE.render(**invoice))
+
+
+def construct_email_reply(
+    content: str, invoice_rows: Optional[List[Markup]] = None
+) -> str:
+    """Construct the email reply based on the response from the LLM."""
+    return HTML_HEAD + construct_email_body(content, invoice_rows)
+
+
+def construct_email_body(
+    content: str, invoice_rows: Optional[List[Markup]] = None
+) -> str:
+    """Construct the HTML body of the email reply, without the head and
+    styles, based on the response from the LLM. Already rendered invoice
+    rows are used when given."""
+    if not content:
+        return ""
+
+    # Structured output guarantees the content matches RESPONSE_SCHEMA.
+    json_data = orjson.loads(content)
+
+    if invoice_rows is None:
+        invoice_rows = map(render_invoice_row, json_data.get("invoices", []))
+
+    return REPLY_BODY_TEMPLATE.render(**json_data, invoice_rows=invoice_rows)
+
+
+def read_emails() -> dict:
+    """Read the emails of all input work items, keyed by the work item id."""
 
     # Loop through input work items, there should be only emails in them.
     # There most likely should be only one item and one email,
-    # but we'll handle multiple just in case.
+    # but we'll handle multiple just in case. All emails are collected
+    # first, so that they can be processed concurrently. Note that the
+    # iteration releases each work item as done once it has been read,
+    # so errors from the LLM or from sending the reply are not reported on
+    # the work item. Instead, the task fails at the end if any reply failed.
+    emails = {}
     for item in workitems.inputs:
-        # Get email from work item, and it's header details that are needed later
         try:
-            email = item.email()
-            inReplyTo = item.payload["email"]["inReplyTo"]
-            references = " ".join(item.payload["email"]["references"])
+            emails[item.id] = read_email(item)
         except Exception as e:
             print(f"Error reading email from payload: {e}")
             break
+    return emails
+
+
+def read_email(item):
+    """Get email from work item, and it's header details that are needed later."""
+    email = item.email()
+    inReplyTo = item.payload["email"]["inReplyTo"]
+    references = " ".join(item.payload["email"]["references"])
+    return email, inReplyTo, references
+
+
+def create_mail_payload(
+    from_email, email, inReplyTo, references, content, invoice_rows=None
+) -> dict:
+    """Create the SendGrid mail payload of a single reply."""
+
+    # Note that the original email content is not added in the reply
+    # at all. You could do that if you want.
+    return {
+        "from": {"email": from_email},
+        "personalizations": [
+            {
+                "to": [{"email": email.from_.address}],
+                "subject": "Re: " + email.subject,
+                # Add headers to put the email in the same thread as the original.
+                "headers": {"in_reply_to": inReplyTo, "References": references},
+            }
+        ],
+        "content": [
+            {
+                "type": "text/html",
+                "value": construct_email_reply(content, invoice_rows),
+            }
+        ],
+    }
 
-        prompt = create_prompt(email.text)
 
-        response = openai.ChatCompletion.create(
-            model=model,
-            temperature=0.1,
-            messages=[
-                {"role": "system", "content": sys_prompt},
-                {"role": "user", "content": prompt},
-            ],
-        )
+def post_mail(sg, payload: dict):
+    """Post the mail payload to SendGrid, raising on error responses."""
+    response = sg.post(f"{SENDGRID_API_URL}/mail/send", json=payload)
+    response.raise_for_status()
 
-        # Print some debug info
-        print(f"*********** TOKEN USAGE *************\n{response['usage']}\n\n")
-        print(
-            f"*********** RESPONSE CONTENT *************\n{response['choices'][0]['message']['content']}\n\n"
-        )
 
-        # Create a reply email. Note that the original email content
-        # is not added in this email at all. You could do that if you want.
-        reply = construct_email_reply(response)
-        message = Mail(
-            from_email=from_email,
-            to_emails=email.from_.address,
-            subject="Re: " + email.subject,
-            html_content=reply,
+async def send_reply(sg, payload: dict) -> bool:
+    """Send a single reply and return whether it succeeded. Each reply is
+    its own request, so a failing reply doesn't affect the others, and the
+    pooled session reuses the connection between them."""
+
+    # SEND IT! The HTTP session is blocking, so run it in a worker thread
+    # to let the LLM requests proceed meanwhile.
+    try:
+        await asyncio.to_thread(post_mail, sg, payload)
+    except Exception:
+        print(traceback.format_exc())
+        return False
+    return True
+
+
+async def reply_to_email(
+    sg, from_email, item_id, email, inReplyTo, references, llm_request
+) -> bool:
+    """Wait for the LLM response of a single email and send the reply as
+    soon as it's available, without waiting for the other emails.
+    Returns whether the reply was sent."""
+
+    try:
+        content, invoice_rows = await llm_request
+    except Exception:
+        print(f"Error getting LLM response for work item {item_id}:")
+        print(traceback.format_exc())
+        return False
+
+    print(f"*********** RESPONSE CONTENT *************\n{content}\n\n")
+    if not content:
+        print(f"Empty or refused LLM response for work item {item_id}, not replying")
+        return False
+
+    try:
+        payload = create_mail_payload(
+            from_email, email, inReplyTo, references, content, invoice_rows
         )
+    except Exception:
+        print(f"Error creating the reply for work item {item_id}:")
+        print(traceback.format_exc())
+        return False
 
-        # Add headers to put the email in the same thread as the original.
-        message.header = [
-            Header("in_reply_to", inReplyTo),
-            Header("References", references),
-        ]
+    return await send_reply(sg, payload)
 
-        # SEND IT!
-        try:
-            response = sg.send(message)
-        except Exception as e:
-            print(traceback.format_exc())
\ No newline at end of file
+
+async def run_bounded(semaphore: asyncio.Semaphore, coro):
+    """Run the coroutine once the semaphore allows it."""
+    async with semaphore:
+        return await coro
+
+
+async def process_all_emails() -> int:
+    """Handle all input work items concurrently and return the number of
+    emails that could not be replied to."""
+
+    # Inititalize it all
+    openai_client, sg, from_email, model = initialize()
+    try:
+        return await handle_emails(openai_client, sg, from_email, model)
+    finally:
+        await openai_client.close()
+
+
+async def handle_emails(openai_client, sg, from_email, model) -> int:
+    """Get the LLM responses for all the input emails and reply to them.
+    Returns the number of emails that could not be replied to."""
+
+    sys_prompt = create_system_prompt()
+
+    # Open the connections while the work items are read, which is done in
+    # a worker thread so that the two overlap.
+    warm_up_task = asyncio.create_task(warm_up(openai_client, sg))
+    emails = await asyncio.to_thread(read_emails)
+
+    # Issue the LLM requests of all emails together over the shared
+    # client. The same discussion can arrive several times (duplicated
+    # triggers, retries), so each unique discussion is sent to the LLM
+    # only once per run. The number of concurrent requests is bounded
+    # to avoid hitting the rate limits.
+    semaphore = asyncio.Semaphore(
+        int(os.getenv("MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+    )
+    llm_requests = {}
+    for email, _, _ in emails.values():
+        if email.text not in llm_requests:
+            llm_requests[email.text] = asyncio.ensure_future(
+                run_bounded(
+                    semaphore,
+                    get_llm_response(openai_client, model, sys_prompt, email.text),
+                )
+            )
+
+    # Each reply is sent as soon as its own LLM response is ready.
+    results = await asyncio.gather(
+        *[
+            reply_to_email(
+                sg,
+                from_email,
+                item_id,
+                email,
+                inReplyTo,
+                references,
+                llm_requests[email.text],
+            )
+            for item_id, (email, inReplyTo, references) in emails.items()
+        ],
+        return_exceptions=True,
+    )
+    await warm_up_task
+
+    for result in results:
+        if isinstance(result, Exception):
+            traceback.print_exception(type(result), result, result.__traceback__)
+    return sum(result is not True for result in results)
+
+
+@task
+def process_emails():
+    """Read email, do LLM magic and reply to the sender."""
+    failed = asyncio.run(process_all_emails())
+
+    # The work items are already released when they are read, so fail the
+    # task to make the errors visible in Control Room.
+    if failed:
+        raise RuntimeError(f"Failed to reply to {failed} email(s), see the log")
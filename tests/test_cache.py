@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+import cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_DIR", str(tmp_path))
+    cache._get_cache.cache_clear()
+    yield tmp_path
+    if cache._get_cache.cache_info().currsize:
+        cache._get_cache().close()
+    cache._get_cache.cache_clear()
+
+
+def _thread(invoice_id: str, amount: str) -> str:
+    return f"""Hi, see status below.
+--
+Mark T. M.
+Accounts Payable
+
+On Fri, Jun 30, 2023 at 11:18:16, Tommi Holmgren wrote:
+
+> Please review the open invoices on your account.
+>
+> {invoice_id} {amount}
+"""
+
+
+def test_signature_does_not_strip_quoted_history():
+    first = _thread("30123924", "26,568.86 GBP")
+    second = _thread("99999999", "31,613.00 EUR")
+
+    assert "30123924" in cache.normalize(first)
+    assert "mark t. m." not in cache.normalize(first)
+    assert cache._exact_key(first, "v") != cache._exact_key(second, "v")
+
+
+def test_keys_depend_on_version():
+    discussion = _thread("30123924", "26,568.86 GBP")
+
+    assert cache._exact_key(discussion, "a") != cache._exact_key(discussion, "b")
+    assert cache._structural_key(discussion, "a") != cache._structural_key(
+        discussion, "b"
+    )
+
+
+def _forwarded_thread(reply: str) -> str:
+    return f"""Please check this one.
+--
+Tommi Holmgren | VP Product
+
+---------- Forwarded message ----------
+From: Mark the Monkey <markthemonkey@somemail.com>
+Subject: Re: Collections Communication - 15066530-HB
+
+Hi,
+
+{reply}
+
+Mark T. M.
+"""
+
+
+def test_signature_does_not_strip_forwarded_message():
+    promise = _forwarded_thread("Invoice 30123924 will get paid on 23.05.2023")
+    dispute = _forwarded_thread("We dispute invoice 30123924")
+
+    assert "will get paid on 23.05.2023" in cache.normalize(promise)
+    assert "vp product" not in cache.normalize(promise)
+    assert cache._exact_key(promise, "v") != cache._exact_key(dispute, "v")
+
+
+def test_store_and_lookup():
+    discussion = _thread("30123924", "26,568.86 GBP")
+
+    assert cache.lookup(discussion, "v") is None
+    cache.store(discussion, "v", '{"summary": "cached"}')
+
+    assert cache.lookup(discussion, "v") == '{"summary": "cached"}'
+    # Whitespace differences normalize to the same key.
+    assert cache.lookup(discussion.replace("\n", "\n\n"), "v") is not None
+    assert cache.lookup(discussion, "other") is None
+
+
+def test_lookup_similar_returns_changed_lines():
+    first = _forwarded_thread("Invoice 30123924 will get paid on 23.05.2023")
+    second = _forwarded_thread("Invoice 30123924 will get paid on 30.05.2023")
+    cache.store(first, "v", '{"summary": "cached"}')
+
+    assert cache.lookup(second, "v") is None
+    diff, content = cache.lookup_similar(second, "v")
+
+    assert content == '{"summary": "cached"}'
+    assert diff.splitlines() == [
+        "- Invoice 30123924 will get paid on 23.05.2023",
+        "+ Invoice 30123924 will get paid on 30.05.2023",
+    ]
+
+
+def test_lookup_similar_requires_same_invoices():
+    cache.store(_thread("30123924", "26,568.86 GBP"), "v", "{}")
+
+    assert cache.lookup_similar(_thread("99999999", "26,568.86 GBP"), "v") is None
+    assert cache.lookup_similar("No invoices here.", "v") is None
+
+
+def test_entries_expire(monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_EXPIRE", 0.05)
+    discussion = _thread("30123924", "26,568.86 GBP")
+    cache.store(discussion, "v", "{}")
+
+    assert cache.lookup(discussion, "v") == "{}"
+    time.sleep(0.1)
+    assert cache.lookup(discussion, "v") is None
+    assert cache.lookup_similar(discussion, "v") is None
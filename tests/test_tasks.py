@@ -0,0 +1,47 @@
+import pytest
+
+import tasks
+
+
+@pytest.mark.parametrize(
+    "discussion",
+    ["Received, thanks", "Out of office until Monday.", ""],
+)
+def test_trivial_discussion(discussion):
+    assert tasks.is_trivial_discussion(discussion)
+
+
+@pytest.mark.parametrize(
+    "discussion",
+    [
+        "Paid 1,200.00 yesterday",
+        "Paid 1,200, thanks",
+        "Paid 45.50",
+        "INV 1234 is paid",
+        "Invoice #123 is paid",
+        "30123924 will be paid",
+    ],
+)
+def test_discussion_with_invoice_or_amount_is_not_trivial(discussion):
+    assert not tasks.is_trivial_discussion(discussion)
+
+
+def test_long_discussion_is_not_trivial():
+    assert not tasks.is_trivial_discussion("Thanks for your message. " * 10)
+
+
+@pytest.mark.parametrize("text", ["INV 1234", "INV-12345", "invoice # 567", "30123924"])
+def test_invoice_reference(text):
+    assert tasks.INVOICE_RE.search(text)
+
+
+@pytest.mark.parametrize("text", ["on 23.05.2023", "due 12.04.23", "call 1.5 hours"])
+def test_date_is_not_amount(text):
+    assert not tasks.MONEY_RE.search(text)
+
+
+@pytest.mark.parametrize(
+    "text", ["1,200.00", "45.50", "$5", "GBP 100", "58,181.86 GBP", "100 EUR"]
+)
+def test_amount(text):
+    assert tasks.MONEY_RE.search(text)